@@ -1,11 +1,27 @@
+import io
 import re
+import threading
 from typing import List, Dict, Optional
 
-from pypdf import PdfReader as _PdfReader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import ahocorasick
+import fitz
+from semantic_text_splitter import TextSplitter
 
 
-PAGE_MARKER_RE = re.compile(r"\[Page\s+(\d+)\]")
+_PAGE_MARKER_STRIP_RE = re.compile(r"\[Page\s+\d+\]\s*")
+_WS_RE = re.compile(r"\s+")
+
+_FITZ_LOCK = threading.Lock()
+
+# Recursive character splitter: falls back from paragraphs to lines,
+# sentences and words, like the separator cascade it replaced.
+_SPLITTER = TextSplitter(1000, overlap=100)
+
+# Upper bound for merged chunks (see chunk_text).
+CHUNK_MAX_SIZE = 1100
+
+# Length of the source excerpt shown with answers.
+EXCERPT_LENGTH = 350
 
 
 LEGAL_KEYWORDS = [
@@ -15,62 +31,91 @@ LEGAL_KEYWORDS = [
     "commission", "execute", "enforceable", "binding", "subcontract"
 ]
 
+_KW_AUTOMATON = ahocorasick.Automaton()
+for _kw in LEGAL_KEYWORDS:
+    _KW_AUTOMATON.add_word(_kw, _kw)
+_KW_AUTOMATON.make_automaton()
+
+
 def is_legal_document(text: str) -> bool:
     """Returns True if the document contains enough legal keywords to be a contract."""
-    text_lower = text.lower()
-    matches = sum(1 for kw in LEGAL_KEYWORDS if kw in text_lower)
-    return matches >= 4
+    seen = set()
+    for _, kw in _KW_AUTOMATON.iter(text.lower()):
+        seen.add(kw)
+        if len(seen) >= 4:
+            return True
+    return False
 
 
 def clean_text(text: str) -> str:
     """Clean and normalize text (does NOT remove our [Page N] markers)."""
-    text = text or ""
-    text = text.replace("\n", " ")
-    text = text.replace("\\n", " ").replace("\\\\n", " ")
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    # Real newlines are covered by \s+; only literal "\n" escapes need mapping.
+    text = (text or "").replace("\\n", " ")
+    return _WS_RE.sub(" ", text).strip()
 
 
 def extract_text_from_pdf(pdf_file) -> str:
     """Read a PDF file and return text with page markers embedded."""
-    pdf_reader = _PdfReader(pdf_file)
-
-    parts: List[str] = []
-    for page_num, page in enumerate(pdf_reader.pages, start=1):
-        page_text = page.extract_text() or ""
-        page_text = page_text.strip()
-        if not page_text:
-            continue
+    pdf_bytes = pdf_file.read()
 
-        cleaned = clean_text(page_text)
-        parts.append(f"[Page {page_num}] {cleaned}\n\n")
-
-    full_text = "".join(parts).strip()
-    print(f"Extracted {len(full_text)} characters from {len(pdf_reader.pages)} pages")
+    # PyMuPDF is not thread-safe, so concurrent uploads take turns here.
+    with _FITZ_LOCK:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        try:
+            buf = io.StringIO()
+            for page_num, page in enumerate(doc, start=1):
+                # sort=False keeps MuPDF's native order and skips the reading-order sort.
+                page_text = page.get_text("text", sort=False) or ""
+                page_text = page_text.strip()
+                if not page_text:
+                    continue
+
+                cleaned = clean_text(page_text)
+                buf.write(f"[Page {page_num}] {cleaned}\n\n")
+
+            page_count = doc.page_count
+        finally:
+            doc.close()
+
+    full_text = buf.getvalue().strip()
+    print(f"Extracted {len(full_text)} characters from {page_count} pages")
     return full_text
 
 
-def chunk_text_with_langchain(text: str) -> List[str]:
-    """Break long text into smaller chunks using LangChain."""
+def _merge_adjacent(text: str, spans: List[tuple], max_size: int) -> List[str]:
+    """Greedily merge neighbouring (start, end) spans while they fit within max_size.
+
+    Merged chunks are sliced from the original text, so splitter overlap
+    between neighbours is kept once rather than duplicated.
+    """
+    merged: List[str] = []
+    cur_start = cur_end = None
+    for start, end in spans:
+        if cur_start is None:
+            cur_start, cur_end = start, end
+        elif max(cur_end, end) - cur_start <= max_size:
+            cur_end = max(cur_end, end)
+        else:
+            merged.append(text[cur_start:cur_end])
+            cur_start, cur_end = start, end
+    if cur_start is not None:
+        merged.append(text[cur_start:cur_end])
+    return merged
+
+
+def chunk_text(text: str) -> List[str]:
+    """Break long text into evenly sized chunks.
+
+    Split with semantic-text-splitter, then greedily merge small
+    neighbouring chunks up to CHUNK_MAX_SIZE characters.
+    """
     text = text or ""
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=500,
-        length_function=len,
-        separators=["\n\n", "\n", ". ", " ", ""],
-        is_separator_regex=False,
-    )
-
-    chunks = splitter.split_text(text)
-
-    cleaned_chunks: List[str] = []
-    for c in chunks:
-        c = (c or "").strip()
-        if not c:
-            continue
-        cleaned_chunks.append(c)
-
-    print(f"Created {len(cleaned_chunks)} chunks using LangChain")
+
+    spans = [(start, start + len(c)) for start, c in _SPLITTER.chunk_indices(text) if c.strip()]
+    chunks = [c.strip() for c in _merge_adjacent(text, spans, CHUNK_MAX_SIZE)]
+    cleaned_chunks = [c for c in chunks if c]
+
+    print(f"Created {len(cleaned_chunks)} chunks")
     return cleaned_chunks
 
 
@@ -79,19 +124,30 @@ def extract_page_from_chunk(chunk: str, last_known_page: Optional[int]) -> Optio
     if not chunk:
         return last_known_page
 
-    matches = list(PAGE_MARKER_RE.finditer(chunk))
-    if matches:
-        try:
-            return int(matches[-1].group(1))
-        except Exception:
-            return last_known_page
+    # Scan backwards so only the last marker is parsed. A marker is "[Page",
+    # one or more whitespace characters, decimal digits, then "]".
+    i = chunk.rfind("[Page")
+    while i != -1:
+        j = chunk.find("]", i)
+        if j != -1:
+            inner = chunk[i + 5:j]
+            digits = inner.lstrip()
+            if inner[:1].isspace() and digits.isdecimal():
+                return int(digits)
+        i = chunk.rfind("[Page", 0, i)
 
     return last_known_page
 
 
 def remove_page_markers(text: str) -> str:
     """Remove [Page N] markers from stored text."""
-    return re.sub(r"\[Page\s+\d+\]\s*", "", text).strip()
+    return _PAGE_MARKER_STRIP_RE.sub("", text).strip()
+
+
+def make_excerpt(text: str) -> str:
+    """Collapse whitespace and truncate to the excerpt shown with sources."""
+    text = " ".join((text or "").split())
+    return (text[:EXCERPT_LENGTH] + "...") if len(text) > EXCERPT_LENGTH else text
 
 
 def embed_page_in_text(text: str, page: Optional[int]) -> str:
@@ -111,7 +167,7 @@ def process_pdf(pdf_file, filename: str) -> List[Dict]:
         if not is_legal_document(text):
             raise ValueError("NOT_A_LEGAL_CONTRACT")
 
-        chunks = chunk_text_with_langchain(text)
+        chunks = chunk_text(text)
         documents: List[Dict] = []
 
         clean_name = (filename or "").replace(".pdf", "").replace(".PDF", "").strip()
@@ -132,6 +188,9 @@ def process_pdf(pdf_file, filename: str) -> List[Dict]:
                 continue
 
             stored_text = embed_page_in_text(clean_chunk, current_page)
+            # Precomputed here so /query can use them without re-cleaning.
+            words = clean_chunk.split()
+            snippet = make_excerpt(clean_chunk)
             page_tag = f"_p{current_page}" if current_page is not None else "_p0"
 
             documents.append({
@@ -139,11 +198,13 @@ def process_pdf(pdf_file, filename: str) -> List[Dict]:
                 "text": stored_text,
                 "metadata": {
                     "source": clean_name,
+                    "doc_name": clean_name.replace("_", " ").strip(),
                     "file_name": filename,
                     "chunk_index": doc_index,
                     "total_chunks": None,
                     "page": current_page,
-                    "word_count": len(clean_chunk.split()),
+                    "word_count": len(words),
+                    "snippet": snippet,
                 },
             })
 
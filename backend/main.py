@@ -4,7 +4,7 @@ from pydantic import BaseModel
 from typing import List, Optional
 import document_processor
 import moorcheh_service
-import io
+import asyncio
 import uvicorn
 
 app = FastAPI(title="Contract Intelligence API")
@@ -45,6 +45,71 @@ def read_root():
     return {"message": "Contract Intelligence API is running!", "status": "healthy"}
 
 
+UPLOAD_CONCURRENCY = 4
+
+
+async def _process_upload(file: UploadFile, namespace: str, semaphore: asyncio.Semaphore) -> dict:
+    """Run one uploaded PDF through extraction and Moorcheh upload."""
+    if not file.filename or not file.filename.lower().endswith(".pdf"):
+        return {
+            "filename": file.filename,
+            "status": "error",
+            "message": "Only PDF files are supported"
+        }
+
+    try:
+        async with semaphore:
+            print(f"Processing: {file.filename}")
+
+            # Hand the spooled upload straight to the parser; it is read
+            # once inside the worker thread instead of being buffered here.
+            await file.seek(0)
+            documents = await asyncio.to_thread(
+                document_processor.process_pdf, file.file, file.filename
+            )
+
+            print(f"Uploading to Moorcheh namespace '{namespace}'...")
+            result = await asyncio.to_thread(
+                moorcheh_service.upload_documents,
+                documents=documents,
+                namespace=namespace
+            )
+
+        if result.get("success"):
+            return {
+                "filename": file.filename,
+                "status": "success",
+                "chunks_created": result.get("count", 0)
+            }
+        return {
+            "filename": file.filename,
+            "status": "error",
+            "message": result.get("error", "Unknown error")
+        }
+
+    except ValueError as e:
+        if "NOT_A_LEGAL_CONTRACT" in str(e):
+            return {
+                "filename": file.filename,
+                "status": "error",
+                "message": "This document does not appear to be a legal contract. Only legal contracts are supported."
+            }
+        return {
+            "filename": file.filename,
+            "status": "error",
+            "message": str(e)
+        }
+    except Exception as e:
+        print(f"Error processing {file.filename}: {e}")
+        return {
+            "filename": file.filename,
+            "status": "error",
+            "message": str(e)
+        }
+    finally:
+        await file.close()
+
+
 @app.post("/upload-contract")
 async def upload_contract(
     files: List[UploadFile] = File(...),
@@ -52,76 +117,18 @@ async def upload_contract(
 ):
     """Upload multiple PDF contracts to a specific namespace."""
     try:
-        results = []
-        total_chunks = 0
-
         print(f"Uploading to namespace: '{x_namespace}'")
 
-        for file in files:
-            if not file.filename or not file.filename.lower().endswith(".pdf"):
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "message": "Only PDF files are supported"
-                })
-                continue
-
-            try:
-                print(f"Processing: {file.filename}")
-
-                pdf_bytes = await file.read()
-                pdf_stream = io.BytesIO(pdf_bytes)
-                pdf_stream.seek(0)
-
-                documents = document_processor.process_pdf(pdf_stream, file.filename)
-
-                print(f"Uploading to Moorcheh namespace '{x_namespace}'...")
-                result = moorcheh_service.upload_documents(
-                    documents=documents,
-                    namespace=x_namespace
-                )
-
-                if result.get("success"):
-                    total_chunks += result.get("count", 0)
-                    results.append({
-                        "filename": file.filename,
-                        "status": "success",
-                        "chunks_created": result.get("count", 0)
-                    })
-                else:
-                    results.append({
-                        "filename": file.filename,
-                        "status": "error",
-                        "message": result.get("error", "Unknown error")
-                    })
-
-            except ValueError as e:
-                if "NOT_A_LEGAL_CONTRACT" in str(e):
-                    results.append({
-                        "filename": file.filename,
-                        "status": "error",
-                        "message": "This document does not appear to be a legal contract. Only legal contracts are supported."
-                    })
-                else:
-                    results.append({
-                        "filename": file.filename,
-                        "status": "error",
-                        "message": str(e)
-                    })
-            except Exception as e:
-                print(f"Error processing {file.filename}: {e}")
-                results.append({
-                    "filename": file.filename,
-                    "status": "error",
-                    "message": str(e)
-                })
-            finally:
-                await file.close()
+        semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+        results = await asyncio.gather(
+            *(_process_upload(file, x_namespace, semaphore) for file in files)
+        )
+        total_chunks = sum(r.get("chunks_created", 0) for r in results)
 
         return {
             "message": f"Processed {len(files)} file(s) in workspace '{x_namespace}'",
             "total_chunks": total_chunks,
-            "results": results
+            "results": list(results)
         }
 
     except Exception as e:
@@ -135,7 +142,9 @@ async def query_contracts(request: QueryRequest):
     try:
         print(f"Searching for: '{request.query}' in namespace: '{request.namespace}'")
 
-        search_results = moorcheh_service.search_contracts(
+        # Off the event loop: search may wait for indexing and runs the MMR encoder.
+        search_results = await asyncio.to_thread(
+            moorcheh_service.search_contracts,
             query=request.query,
             namespace=request.namespace,
             top_k=request.top_k
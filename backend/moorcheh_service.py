@@ -1,16 +1,92 @@
+import hashlib
 import os
 import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import numpy as np
+import onnxruntime
+import torch
 from dotenv import load_dotenv
+from document_processor import make_excerpt
 from moorcheh_sdk import MoorchehClient
-from sklearn.metrics.pairwise import cosine_similarity
 from sentence_transformers import SentenceTransformer
 
 load_dotenv()
 
 moorcheh_client = MoorchehClient(api_key=os.getenv("MOORCHEH_API_KEY"))
 
-_embedder = SentenceTransformer("all-MiniLM-L6-v2")
+_device = "cuda" if torch.cuda.is_available() else "cpu"
+
+if _device == "cuda":
+    _embedder = SentenceTransformer("all-MiniLM-L6-v2", device=_device)
+    _embedder.half()
+else:
+    # On CPU, run a dynamically INT8-quantized ONNX export through ONNX Runtime.
+    _ort_options = onnxruntime.SessionOptions()
+    _ort_options.intra_op_num_threads = os.cpu_count() or 1
+    _embedder = SentenceTransformer(
+        "all-MiniLM-L6-v2",
+        device=_device,
+        backend="onnx",
+        model_kwargs={
+            "file_name": os.getenv("EMBEDDER_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx"),
+            "provider": "CPUExecutionProvider",
+            "session_options": _ort_options,
+        },
+    )
+
+_embedder.max_seq_length = 256  # MiniLM was trained on 256-token inputs
+
+UPLOAD_BATCH_SIZE = 64
+UPLOAD_MAX_WORKERS = 8
+
+# Searches within this window after an upload wait out the remainder so
+# freshly uploaded chunks are indexed; uploads themselves no longer block.
+# Upload times live in process memory, so the wait only covers searches
+# served by the same worker process that handled the upload.
+INDEXING_DELAY_SECONDS = 2.0
+_recent_uploads: dict = {}
+_recent_uploads_lock = threading.Lock()
+
+_EMBED_CACHE_SIZE = 4096
+_embed_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+_embed_cache_lock = threading.Lock()
+
+
+def _encode_cached(texts: list) -> np.ndarray:
+    """Encode texts to normalized float32 embeddings through an LRU cache.
+    Cache misses are encoded together in a single batch.
+    """
+    keys = [hashlib.blake2b(t.encode("utf-8"), digest_size=16).digest() for t in texts]
+
+    with _embed_cache_lock:
+        found = {k: _embed_cache[k] for k in keys if k in _embed_cache}
+
+    missing = {k: t for k, t in zip(keys, texts) if k not in found}
+    if missing:
+        with torch.inference_mode():
+            new_embs = _embedder.encode(
+                list(missing.values()),
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+        # Copy each row so a cached vector does not pin its whole batch in memory.
+        found.update(
+            (k, np.array(row, dtype=np.float32)) for k, row in zip(missing, new_embs)
+        )
+
+    with _embed_cache_lock:
+        for k in keys:
+            _embed_cache[k] = found[k]
+            _embed_cache.move_to_end(k)
+        while len(_embed_cache) > _EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+
+    return np.stack([found[k] for k in keys])
 
 
 def apply_mmr(matches: list, query: str, top_k: int = 5, lambda_mult: float = 0.5) -> list:
@@ -22,36 +98,26 @@ def apply_mmr(matches: list, query: str, top_k: int = 5, lambda_mult: float = 0.
 
     texts = [(m.get("text") or "").strip() for m in matches]
 
-    query_emb = _embedder.encode([query])
-    doc_embs = _embedder.encode(texts)
+    embs = _encode_cached([query] + texts)
+    query_emb, doc_embs = embs[0], embs[1:]
+
+    # Embeddings are L2-normalized, so cosine similarity is a plain dot product.
+    relevance = doc_embs @ query_emb
+    similarity = doc_embs @ doc_embs.T
 
+    # Running max similarity to the selected chunks; may be negative, so it
+    # starts at -inf and the first pick uses zero redundancy instead.
+    max_sim = np.full(len(matches), -np.inf, dtype=relevance.dtype)
     selected_indices = []
-    remaining_indices = list(range(len(matches)))
 
     for _ in range(min(top_k, len(matches))):
-        best_idx = None
-        best_score = float("-inf")
-
-        for i in remaining_indices:
-            relevance = cosine_similarity(query_emb, [doc_embs[i]])[0][0]
+        redundancy = max_sim if selected_indices else 0.0
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected_indices] = -np.inf
 
-            if selected_indices:
-                redundancy = max(
-                    cosine_similarity([doc_embs[i]], [doc_embs[j]])[0][0]
-                    for j in selected_indices
-                )
-            else:
-                redundancy = 0.0
-
-            score = lambda_mult * relevance - (1 - lambda_mult) * redundancy
-
-            if score > best_score:
-                best_score = score
-                best_idx = i
-
-        if best_idx is not None:
-            selected_indices.append(best_idx)
-            remaining_indices.remove(best_idx)
+        best_idx = int(scores.argmax())
+        selected_indices.append(best_idx)
+        np.maximum(max_sim, similarity[best_idx], out=max_sim)
 
     return [matches[i] for i in selected_indices]
 
@@ -71,6 +137,37 @@ def create_namespace(namespace: str):
             raise
 
 
+def _record_upload(namespace: str):
+    """Remember when a namespace was last uploaded to, dropping expired entries."""
+    now = time.monotonic()
+    with _recent_uploads_lock:
+        expired = [ns for ns, t in _recent_uploads.items() if now - t >= INDEXING_DELAY_SECONDS]
+        for ns in expired:
+            del _recent_uploads[ns]
+        _recent_uploads[namespace] = now
+
+
+def _wait_for_indexing(namespace: str):
+    """Give a just-uploaded namespace time to index before it is searched.
+    Only the remainder of INDEXING_DELAY_SECONDS since the upload is slept,
+    so callers on the event loop must run this in a worker thread.
+    """
+    with _recent_uploads_lock:
+        uploaded_at = _recent_uploads.get(namespace)
+    if uploaded_at is None:
+        return
+
+    remaining = INDEXING_DELAY_SECONDS - (time.monotonic() - uploaded_at)
+    if remaining > 0:
+        print(f"Waiting {remaining:.1f}s for indexing of '{namespace}'...")
+        time.sleep(remaining)
+
+    # Leave the entry alone if another upload landed while we waited.
+    with _recent_uploads_lock:
+        if _recent_uploads.get(namespace) == uploaded_at:
+            del _recent_uploads[namespace]
+
+
 def upload_documents(documents: list, namespace: str):
     """Upload documents to Moorcheh using TEXT search."""
     create_namespace(namespace)
@@ -80,14 +177,23 @@ def upload_documents(documents: list, namespace: str):
             print(f"First chunk ID: {documents[0].get('id')}")
             print(f"Text length: {len(documents[0].get('text', ''))} chars")
 
-        print(f"Uploading {len(documents)} documents to namespace '{namespace}'...")
-        moorcheh_client.upload_documents(
-            namespace_name=namespace,
-            documents=documents
-        )
+        batches = [
+            documents[i:i + UPLOAD_BATCH_SIZE]
+            for i in range(0, len(documents), UPLOAD_BATCH_SIZE)
+        ]
+        print(f"Uploading {len(documents)} documents to namespace '{namespace}' in {len(batches)} batch(es)...")
 
-        print("Waiting 2 seconds for indexing...")
-        time.sleep(2)
+        def _upload_batch(batch: list):
+            return moorcheh_client.upload_documents(
+                namespace_name=namespace,
+                documents=batch
+            )
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+            # list() re-raises the first failed batch's exception here.
+            list(executor.map(_upload_batch, batches))
+
+        _record_upload(namespace)
 
         print(f"Upload complete: {len(documents)} chunks!")
         return {"success": True, "count": len(documents)}
@@ -102,6 +208,8 @@ def upload_documents(documents: list, namespace: str):
 def search_contracts(query: str, namespace: str, top_k: int = 10):
     """Search for relevant contract sections using TEXT semantic search."""
     try:
+        _wait_for_indexing(namespace)
+
         print(f"Searching: '{query}' in namespace '{namespace}'")
         results = moorcheh_client.search(
             namespaces=[namespace],
@@ -130,6 +238,14 @@ def search_contracts(query: str, namespace: str, top_k: int = 10):
 
 _PAGE_IN_TEXT_RE = re.compile(r"^\[p:(\d+)\]\s*")
 _PAGE_IN_ID_RE = re.compile(r"_p(\d+)_chunk_")
+_CITED_RE = re.compile(r"\bSources?\s+(\d+(?:[\s,]+(?:and\s+)?\d+)*)", re.IGNORECASE)
+_NUM_RE = re.compile(r"\d+")
+
+
+def _clean_snippet(s: str) -> str:
+    """Strip the [p:N] tag and collapse whitespace in stored chunk text."""
+    s = _PAGE_IN_TEXT_RE.sub("", s or "")
+    return " ".join(s.replace("\n", " ").split()).strip()
 
 
 def _extract_page_fallback(match: dict, metadata: dict):
@@ -140,27 +256,23 @@ def _extract_page_fallback(match: dict, metadata: dict):
     Returns int or None.
     """
     page = metadata.get("page")
-    if page is not None:
-        try:
-            return int(page)
-        except Exception:
-            pass
-
+    if isinstance(page, int) and not isinstance(page, bool):
+        return page
+    if isinstance(page, float) and page.is_integer():
+        return int(page)
+    if isinstance(page, str) and page.strip().isdecimal():
+        return int(page)
+
+    # Both patterns capture \d+, so int() cannot fail on their groups.
     raw_text = match.get("text", "") or match.get("content", "") or ""
     m = _PAGE_IN_TEXT_RE.match(raw_text)
     if m:
-        try:
-            return int(m.group(1))
-        except Exception:
-            pass
+        return int(m.group(1))
 
     doc_id = match.get("id", "") or ""
     m = _PAGE_IN_ID_RE.search(doc_id)
     if m:
-        try:
-            return int(m.group(1))
-        except Exception:
-            pass
+        return int(m.group(1))
 
     return None
 
@@ -174,8 +286,8 @@ def filter_cited_sources(answer: str, sources: list) -> list:
       - (Sources 1, 2, and 3)
     """
     cited_nums = set()
-    for m in re.finditer(r"\bSources?\s+([\d]+(?:[\s,]+(?:and\s+)?[\d]+)*)", answer, re.IGNORECASE):
-        nums = re.findall(r"\d+", m.group(1))
+    for m in _CITED_RE.finditer(answer):
+        nums = _NUM_RE.findall(m.group(1))
         cited_nums.update(int(n) for n in nums)
 
     if not cited_nums:
@@ -184,55 +296,66 @@ def filter_cited_sources(answer: str, sources: list) -> list:
     return [s for s in sources if s.get("source_num") in cited_nums]
 
 
-def build_sources_from_matches(search_results: dict, max_sources: int = 5) -> list:
-    """Build sources payload (document/page/excerpt) from search matches."""
-    matches = (search_results or {}).get("matches", []) or []
-    sources = []
-    source_num = 0
+def _document_name(match: dict, metadata: dict) -> str:
+    """Derive a display name from metadata, falling back to the chunk ID."""
+    file_name = (metadata.get("file_name") or metadata.get("source") or "").strip()
 
-    def clean_snippet(s: str) -> str:
-        s = _PAGE_IN_TEXT_RE.sub("", s or "")
-        return " ".join(s.replace("\n", " ").split()).strip()
+    doc_id = match.get("id", "") or ""
+    if not file_name and doc_id:
+        file_name = _PAGE_IN_ID_RE.split(doc_id)[0] or doc_id.split("_chunk_")[0]
+        file_name = file_name.strip()
 
-    for match in matches[:max_sources]:
-        metadata = match.get("metadata", {}) or {}
+    return (
+        (file_name or "Unknown Document")
+        .replace(".pdf", "")
+        .replace(".PDF", "")
+        .replace("_", " ")
+        .strip()
+    )
 
-        raw_text = match.get("text", "") or match.get("content", "") or ""
-        text = clean_snippet(raw_text)
-        if not text:
-            continue
 
-        source_num += 1
+def _describe_match(match: dict, excerpt: bool = False) -> tuple:
+    """Return (clean_text, document_name, page) for one search match.
 
-        doc_id = match.get("id", "") or ""
-        file_name = (metadata.get("file_name") or metadata.get("source") or "").strip()
+    With excerpt=True the text is the short source excerpt. Chunks uploaded
+    with precomputed 'snippet'/'doc_name' metadata skip the cleanup work;
+    older chunks fall back to deriving everything from text and ID.
+    """
+    metadata = match.get("metadata", {}) or {}
 
-        if not file_name and doc_id:
-            file_name = _PAGE_IN_ID_RE.split(doc_id)[0]
-            if not file_name:
-                file_name = doc_id.split("_chunk_")[0]
-            file_name = (file_name or "Unknown Document").strip()
+    text = metadata.get("snippet") if excerpt else None
+    if not text:
+        text = _clean_snippet(match.get("text", "") or match.get("content", "") or "")
+        if excerpt:
+            text = make_excerpt(text)
+    if not text:
+        return text, None, None
+
+    document_name = metadata.get("doc_name") or _document_name(match, metadata)
+    return text, document_name, _extract_page_fallback(match, metadata)
 
-        document_name = (
-            file_name.replace(".pdf", "")
-            .replace(".PDF", "")
-            .replace("_", " ")
-            .strip()
-        )
 
-        page = _extract_page_fallback(match, metadata)
-        page_info = f"Page {page}" if page is not None else "Location Unknown"
-        source_label = f"{document_name} - {page_info}"
+def _page_info(page) -> str:
+    """Human-readable page label used in source headers."""
+    return f"Page {page}" if page is not None else "Location Unknown"
+
+
+def build_sources_from_matches(search_results: dict, max_sources: int = 5) -> list:
+    """Build sources payload (document/page/excerpt) from search matches."""
+    matches = (search_results or {}).get("matches", []) or []
+    rows = [_describe_match(match, excerpt=True) for match in matches[:max_sources]]
+    rows = [row for row in rows if row[0]]
 
-        sources.append({
+    return [
+        {
             "source_num": source_num,
             "document": document_name,
             "page": page,
-            "source": source_label,
-            "excerpt": (text[:350] + "...") if len(text) > 350 else text,
-        })
-
-    return sources
+            "source": f"{document_name} - {_page_info(page)}",
+            "excerpt": text,
+        }
+        for source_num, (text, document_name, page) in enumerate(rows, start=1)
+    ]
 
 
 def generate_answer_with_moorcheh(
@@ -247,41 +370,12 @@ def generate_answer_with_moorcheh(
     if not matches:
         return {"answer": "No relevant information found in the uploaded contracts."}
 
-    def clean_text(s: str) -> str:
-        s = _PAGE_IN_TEXT_RE.sub("", s or "")
-        return " ".join(s.replace("\n", " ").split()).strip()
-
-    context_parts = []
-
-    for match in matches:
-        if len(context_parts) >= top_k:
-            break
-
-        metadata = match.get("metadata", {}) or {}
-        text = clean_text(match.get("text", "") or match.get("content", ""))
-        if not text:
-            continue
-
-        doc_id = match.get("id", "") or ""
-        file_name = (
-            metadata.get("file_name")
-            or metadata.get("source")
-            or (_PAGE_IN_ID_RE.split(doc_id)[0] if doc_id else "")
-            or "Unknown Document"
-        )
-
-        doc_name = (
-            file_name.replace(".pdf", "")
-            .replace(".PDF", "")
-            .replace("_", " ")
-            .strip()
-        )
-
-        page = _extract_page_fallback(match, metadata)
-        page_info = f"Page {page}" if page is not None else "Location Unknown"
-
-        source_num = len(context_parts) + 1
-        context_parts.append(f"Source {source_num}: {doc_name} - {page_info}\n{text}")
+    # Stop describing matches as soon as top_k readable ones are found.
+    rows = list(islice((row for row in map(_describe_match, matches) if row[0]), top_k))
+    context_parts = [
+        f"Source {source_num}: {doc_name} - {_page_info(page)}\n{text}"
+        for source_num, (text, doc_name, page) in enumerate(rows, start=1)
+    ]
 
     if not context_parts:
         return {"answer": "Found matches but no readable text."}